@@ -13,6 +13,7 @@ logger = logging.getLogger(__name__)
 SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60  # Increased expiration time for testing
+ADMIN_USERNAMES = {name.strip() for name in os.getenv("ADMIN_USERNAMES", "").split(",") if name.strip()}
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/token")
 
@@ -25,6 +26,9 @@ def authenticate_user(db: Session, username: str, password: str):
     logger.warning(f"Authentication failed for user: {username}")
     return None
 
+def is_admin(user) -> bool:
+    return user.username in ADMIN_USERNAMES
+
 def create_access_token(data: dict, expires_delta: timedelta = None):
     logger.debug(f"Creating access token for data: {data}")
     to_encode = data.copy()
@@ -0,0 +1,143 @@
+import os
+import json
+import asyncio
+import logging
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from typing import DefaultDict, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+# Messages buffered per in-memory subscriber before it is cut off as too slow
+BROKER_QUEUE_SIZE = int(os.getenv("BROKER_QUEUE_SIZE", 1000))
+
+
+class SubscriptionClosed(Exception):
+    """
+    Raised when reading from a subscription the broker has closed.
+    """
+
+
+class Subscription(ABC):
+    """
+    A subscription to a single channel.
+    """
+
+    @abstractmethod
+    async def get_message(self, timeout: float = 1.0) -> Optional[dict]:
+        """
+        Wait up to `timeout` seconds for the next message, returning None if none arrived.
+        """
+
+    @abstractmethod
+    async def unsubscribe(self):
+        pass
+
+
+class Broker(ABC):
+    """
+    Publish/subscribe transport used to fan chat room events out to WebSocket connections.
+    """
+
+    @abstractmethod
+    async def publish(self, channel: str, message: dict):
+        pass
+
+    @abstractmethod
+    async def subscribe(self, channel: str) -> Subscription:
+        pass
+
+    async def close(self):
+        pass
+
+
+class RedisSubscription(Subscription):
+    def __init__(self, pubsub, channel: str):
+        self.pubsub = pubsub
+        self.channel = channel
+
+    async def get_message(self, timeout: float = 1.0) -> Optional[dict]:
+        message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=timeout)
+        if message:
+            return json.loads(message['data'])
+        return None
+
+    async def unsubscribe(self):
+        await self.pubsub.unsubscribe(self.channel)
+        await self.pubsub.aclose()
+
+
+class RedisBroker(Broker):
+    """
+    Broker backed by Redis pub/sub, delivering messages to every worker in the cluster.
+    """
+
+    def __init__(self, redis_client):
+        self.redis_client = redis_client
+
+    async def publish(self, channel: str, message: dict):
+        await self.redis_client.publish(channel, json.dumps(message))
+
+    async def subscribe(self, channel: str) -> Subscription:
+        pubsub = self.redis_client.pubsub()
+        await pubsub.subscribe(channel)
+        return RedisSubscription(pubsub, channel)
+
+
+class InMemorySubscription(Subscription):
+    def __init__(self, broker: "InMemoryBroker", channel: str, max_queue_size: int):
+        self.broker = broker
+        self.channel = channel
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue_size)
+        self.closed = False
+
+    async def get_message(self, timeout: float = 1.0) -> Optional[dict]:
+        if self.closed:
+            raise SubscriptionClosed(f"Subscription to {self.channel} was closed")
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def unsubscribe(self):
+        self.broker.remove(self)
+
+
+class InMemoryBroker(Broker):
+    """
+    Broker for single-node deployments that delivers messages within this process.
+
+    Published dicts are handed to every subscriber as-is, without serializing
+    or copying them, so subscribers must treat messages as read-only. Like
+    Redis with its output buffer limit, a subscriber that falls more than
+    `max_queue_size` messages behind is closed instead of buffering forever.
+    """
+
+    def __init__(self, max_queue_size: int = BROKER_QUEUE_SIZE):
+        self.max_queue_size = max_queue_size
+        self.channels: DefaultDict[str, Set[InMemorySubscription]] = defaultdict(set)
+
+    async def publish(self, channel: str, message: dict):
+        for subscription in list(self.channels.get(channel, ())):
+            try:
+                subscription.queue.put_nowait(message)
+            except asyncio.QueueFull:
+                logger.warning(f"Closing subscriber on {channel} that fell {self.max_queue_size} messages behind")
+                subscription.closed = True
+                self.remove(subscription)
+
+    async def subscribe(self, channel: str) -> Subscription:
+        subscription = InMemorySubscription(self, channel, self.max_queue_size)
+        self.channels[channel].add(subscription)
+        return subscription
+
+    def remove(self, subscription: InMemorySubscription):
+        subscribers = self.channels.get(subscription.channel)
+        if subscribers is None:
+            return
+        subscribers.discard(subscription)
+        if not subscribers:
+            del self.channels[subscription.channel]
+
+    async def close(self):
+        self.channels.clear()
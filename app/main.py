@@ -1,8 +1,7 @@
 import os
 import logging
 import asyncio
-import json
-from typing import List
+from typing import List, Optional
 from fastapi import (
     FastAPI,
     WebSocket,
@@ -22,7 +21,10 @@ from starlette.datastructures import State
 from fastapi.security import OAuth2PasswordRequestForm
 from . import models, schemas
 from .database import SessionLocal, engine
-from .auth import authenticate_user, create_access_token, get_current_user_from_token, get_current_user
+from .auth import authenticate_user, create_access_token, get_current_user_from_token, get_current_user, is_admin
+from .presence import PresenceService, LocalPresenceService
+from .broker import RedisBroker, InMemoryBroker, SubscriptionClosed
+from . import retention
 import redis.asyncio as redis
 
 # Configure logging
@@ -49,27 +51,55 @@ async def read_index():
 # Application startup event
 @app.on_event("startup")
 async def startup():
-    # Initialize Redis client
-    redis_host = os.getenv("REDIS_HOST", "localhost")
-    redis_port = int(os.getenv("REDIS_PORT", 6379))
-    logger.debug(f"Connecting to Redis at {redis_host}:{redis_port}")
-    app.state.redis_client = redis.Redis(
-        host=redis_host,
-        port=redis_port,
-        db=0,
-        encoding='utf-8',
-        decode_responses=True,
-    )
-    try:
-        await app.state.redis_client.ping()
-        logger.info("Successfully connected to Redis")
-    except Exception as e:
-        logger.error(f"Error connecting to Redis: {str(e)}")
+    # Select the message broker: "redis" for multi-worker deployments,
+    # "memory" for a single process without Redis, "auto" for Redis with a
+    # fallback to memory when it cannot be reached
+    broker_backend = os.getenv("BROKER_BACKEND", "redis")
+    if broker_backend not in ("redis", "memory", "auto"):
+        raise ValueError(f"Unknown BROKER_BACKEND: {broker_backend}")
+    app.state.redis_client = None
+    if broker_backend in ("redis", "auto"):
+        # Initialize Redis client
+        redis_host = os.getenv("REDIS_HOST", "localhost")
+        redis_port = int(os.getenv("REDIS_PORT", 6379))
+        logger.debug(f"Connecting to Redis at {redis_host}:{redis_port}")
+        redis_client = redis.Redis(
+            host=redis_host,
+            port=redis_port,
+            db=0,
+            encoding='utf-8',
+            decode_responses=True,
+        )
+        try:
+            await redis_client.ping()
+            logger.info("Successfully connected to Redis")
+            app.state.redis_client = redis_client
+        except Exception as e:
+            logger.error(f"Error connecting to Redis: {str(e)}")
+            await redis_client.close()
+            if broker_backend == "redis":
+                raise RuntimeError(f"Could not connect to Redis at {redis_host}:{redis_port}") from e
+            logger.warning("Falling back to in-memory message broker")
+    if app.state.redis_client:
+        app.state.broker = RedisBroker(app.state.redis_client)
+        app.state.presence = PresenceService(app.state.redis_client, app.state.broker.publish)
+    else:
+        logger.info("Using in-memory message broker")
+        app.state.broker = InMemoryBroker()
+        app.state.presence = LocalPresenceService(app.state.broker.publish)
+
+    # Start tracking online users per chat room
+    await app.state.presence.start()
 
     # Create database tables and ensure the 'General' chat room exists
     logger.debug("Creating database tables if they do not exist")
     models.Base.metadata.create_all(bind=engine)
     db = SessionLocal()
+    try:
+        retention.ensure_partitions(db)
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Error creating message partitions: {e}", exc_info=True)
     try:
         general_chat_room = db.query(models.ChatRoom).filter(models.ChatRoom.name == 'General').first()
         if not general_chat_room:
@@ -85,9 +115,23 @@ async def startup():
     finally:
         db.close()
 
+    # Start archiving messages past their chat room's retention period
+    app.state.archiver_task = None
+    if retention.ARCHIVER_ENABLED:
+        app.state.archiver_task = asyncio.create_task(retention.run_archiver())
+
 # Application shutdown event
 @app.on_event("shutdown")
 async def shutdown():
+    if app.state.archiver_task:
+        logger.debug("Stopping message archiver")
+        app.state.archiver_task.cancel()
+    if app.state.presence:
+        logger.debug("Stopping presence service")
+        await app.state.presence.stop()
+    if app.state.broker:
+        logger.debug("Closing message broker")
+        await app.state.broker.close()
     if app.state.redis_client:
         logger.debug("Closing Redis connection")
         await app.state.redis_client.close()
@@ -190,15 +234,91 @@ def list_chat_rooms(
     logger.debug(f"Found {len(chat_rooms)} chat rooms")
     return chat_rooms
 
+# Endpoint to get the number of users online in a chat room
+@app.get("/chat_rooms/{chat_room_id}/presence", response_model=schemas.Presence)
+async def get_presence(
+    chat_room_id: int,
+    current_user: models.User = Depends(get_current_user),
+):
+    logger.debug(f"User {current_user.username} is requesting presence for chat room {chat_room_id}")
+    online_count = await app.state.presence.online_count(chat_room_id)
+    return {"chat_room_id": chat_room_id, "online_count": online_count}
+
+# Endpoint to set a chat room's message retention policy (admins only)
+@app.put("/chat_rooms/{chat_room_id}/retention", response_model=schemas.RetentionPolicy)
+def set_retention_policy(
+    chat_room_id: int,
+    policy: schemas.RetentionPolicyUpdate,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user),
+):
+    logger.debug(f"User {current_user.username} is setting retention of chat room {chat_room_id} to {policy.retention_days} days")
+    if not is_admin(current_user):
+        logger.warning(f"User {current_user.username} is not authorized to set retention policies")
+        raise HTTPException(status_code=403, detail="Not authorized to set retention policies")
+    chat_room = db.query(models.ChatRoom).filter(models.ChatRoom.id == chat_room_id).first()
+    if not chat_room:
+        logger.error(f"Chat room not found: ID {chat_room_id}")
+        raise HTTPException(status_code=404, detail="Chat room not found")
+    if policy.retention_days is not None and policy.retention_days < retention.MIN_RETENTION_DAYS:
+        logger.warning(f"Retention period below minimum: {policy.retention_days} days")
+        raise HTTPException(
+            status_code=400,
+            detail=f"Retention period must be at least {retention.MIN_RETENTION_DAYS} days",
+        )
+    retention_policy = models.RetentionPolicy(chat_room_id=chat_room_id, retention_days=policy.retention_days)
+    retention_policy = db.merge(retention_policy)
+    db.commit()
+    logger.info(f"Retention policy updated for chat room {chat_room_id}")
+    return retention_policy
+
+# Endpoint to get message history, oldest messages are read from the archive
+@app.get("/chat_rooms/{chat_room_id}/messages", response_model=List[schemas.Message])
+def get_message_history(
+    chat_room_id: int,
+    before_id: Optional[int] = None,
+    limit: int = Query(50, ge=1, le=500),
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user),
+):
+    logger.debug(f"User {current_user.username} is reading history of chat room {chat_room_id} before message {before_id}")
+    membership = (
+        db.query(models.Membership)
+        .filter_by(user_id=current_user.id, chat_room_id=chat_room_id)
+        .first()
+    )
+    if not membership:
+        logger.warning(f"User {current_user.username} is not a member of chat room {chat_room_id}")
+        raise HTTPException(status_code=403, detail="Not a member of this chat room")
+    query = db.query(models.Message).filter(models.Message.chat_room_id == chat_room_id)
+    if before_id is not None:
+        query = query.filter(models.Message.id < before_id)
+    messages = query.order_by(models.Message.id.desc()).limit(limit).all()
+    if len(messages) < limit:
+        oldest_id = messages[-1].id if messages else before_id
+        messages.extend(retention.archived_history(chat_room_id, oldest_id, limit - len(messages)))
+    logger.debug(f"Returning {len(messages)} messages")
+    return messages
+
 # Endpoint to search messages
 @app.get("/chat_rooms/{chat_room_id}/search", response_model=List[schemas.Message])
 def search_messages(
     chat_room_id: int,
     query: str,
+    include_archived: bool = False,
     db: Session = Depends(get_db),
     current_user: models.User = Depends(get_current_user),
 ):
     logger.debug(f"User {current_user.username} is searching messages in chat room {chat_room_id} with query '{query}'")
+    if include_archived:
+        membership = (
+            db.query(models.Membership)
+            .filter_by(user_id=current_user.id, chat_room_id=chat_room_id)
+            .first()
+        )
+        if not membership:
+            logger.warning(f"User {current_user.username} is not a member of chat room {chat_room_id}")
+            raise HTTPException(status_code=403, detail="Not a member of this chat room")
     messages = (
         db.query(models.Message)
         .filter(
@@ -207,6 +327,8 @@ def search_messages(
         )
         .all()
     )
+    if include_archived:
+        messages.extend(retention.search_archived_messages(chat_room_id, query))
     logger.debug(f"Found {len(messages)} messages matching query")
     return messages
 
@@ -294,30 +416,41 @@ async def websocket_endpoint(websocket: WebSocket, chat_room_id: int, token: str
             await websocket.close(code=1008, reason="Not a member of the chat room")
             return
 
-        # Use Redis client from app.state
-        redis_client = app.state.redis_client
+        # Use message broker and presence service from app.state
+        broker = app.state.broker
+        presence = app.state.presence
+        channel = f"chat_room_{chat_room_id}"
+        subscription = None
+        send_task = None
+        # Set by the send task when the broker cuts this subscriber off; the
+        # send task then cancels the receive loop, which closes the socket
+        receive_task = asyncio.current_task()
+        subscription_lost = asyncio.Event()
 
-        # Subscribe to Redis channel
-        redis_channel = f"chat_room_{chat_room_id}"
-        pubsub = redis_client.pubsub()
-        await pubsub.subscribe(redis_channel)
-        logger.debug(f"Subscribed to Redis channel: {redis_channel}")
+        try:
+            # Subscribe to the chat room channel
+            subscription = await broker.subscribe(channel)
+            logger.debug(f"Subscribed to channel: {channel}")
 
-        async def send_messages():
-            try:
-                while True:
-                    message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
-                    if message:
-                        data = json.loads(message['data'])
-                        logger.debug(f"Received message from Redis: {data}")
-                        await websocket.send_json(data)
-                    await asyncio.sleep(0.01)  # Prevent tight loop
-            except Exception as e:
-                logger.error(f"Error in send_messages task: {e}", exc_info=True)
-
-        send_task = asyncio.create_task(send_messages())
+            # Mark the user as online in the chat room
+            await presence.join(chat_room_id, current_user.username)
+
+            async def send_messages():
+                try:
+                    while True:
+                        data = await subscription.get_message(timeout=1.0)
+                        if data:
+                            logger.debug(f"Received message from broker: {data}")
+                            await websocket.send_json(data)
+                except SubscriptionClosed as e:
+                    logger.warning(f"Subscription lost for {current_user.username}: {e}")
+                    subscription_lost.set()
+                    receive_task.cancel()
+                except Exception as e:
+                    logger.error(f"Error in send_messages task: {e}", exc_info=True)
+
+            send_task = asyncio.create_task(send_messages())
 
-        try:
             while True:
                 data = await websocket.receive_json()
                 logger.debug(f"Received data from client: {data}")
@@ -341,16 +474,16 @@ async def websocket_endpoint(websocket: WebSocket, chat_room_id: int, token: str
                         "is_attachment": is_attachment,
                         "message_id": message.id,
                     }
-                    # Publish the message to Redis
-                    await redis_client.publish(redis_channel, json.dumps(msg))
-                    logger.debug(f"Published message to Redis channel {redis_channel}: {msg}")
+                    # Publish the message to the chat room
+                    await broker.publish(channel, msg)
+                    logger.debug(f"Published message to channel {channel}: {msg}")
                     # Send the message back to the sender
                     await websocket.send_json(msg)
                 elif message_type == "typing":
                     # Broadcast typing indicator
                     msg = {"type": "typing", "username": current_user.username}
-                    await redis_client.publish(redis_channel, json.dumps(msg))
-                    logger.debug(f"Published typing indicator to Redis channel {redis_channel}: {msg}")
+                    await broker.publish(channel, msg)
+                    logger.debug(f"Published typing indicator to channel {channel}: {msg}")
                 elif message_type == "reaction":
                     # Handle reactions
                     reaction_type = data.get("reaction_type")
@@ -366,8 +499,8 @@ async def websocket_endpoint(websocket: WebSocket, chat_room_id: int, token: str
                         "reaction_type": reaction_type,
                         "username": current_user.username,
                     }
-                    await redis_client.publish(redis_channel, json.dumps(msg))
-                    logger.debug(f"Published reaction to Redis channel {redis_channel}: {msg}")
+                    await broker.publish(channel, msg)
+                    logger.debug(f"Published reaction to channel {channel}: {msg}")
                 elif message_type == "read_receipt":
                     # Handle read receipts
                     message_id = data.get("message_id")
@@ -381,14 +514,22 @@ async def websocket_endpoint(websocket: WebSocket, chat_room_id: int, token: str
                 # Add handling for other message types if needed
         except WebSocketDisconnect:
             logger.info(f"Client {current_user.username} disconnected from chat room {chat_room_id}")
-            send_task.cancel()
-            await pubsub.unsubscribe(redis_channel)
+        except asyncio.CancelledError:
+            if not subscription_lost.is_set():
+                raise
+            logger.warning(f"Closing WebSocket for {current_user.username}: too slow to keep up with the chat room")
+            await websocket.close(code=1013, reason="Too slow to keep up with the chat room")
         except Exception as e:
             logger.error(f"Error during WebSocket communication: {e}", exc_info=True)
-            send_task.cancel()
-            await pubsub.unsubscribe(redis_channel)
             await websocket.close()
         finally:
+            if send_task:
+                send_task.cancel()
+            try:
+                await presence.leave(chat_room_id, current_user.username)
+            finally:
+                if subscription:
+                    await subscription.unsubscribe()
             logger.debug(f"WebSocket connection closed for user {current_user.username}")
     except HTTPException as e:
         logger.error(f"Authentication failed: {e.detail}")
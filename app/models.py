@@ -5,14 +5,24 @@ from sqlalchemy import (
     ForeignKey,
     DateTime,
     Boolean,
+    Index,
     func,
 )
 from sqlalchemy.orm import relationship
 from passlib.context import CryptContext
-from .database import Base
+from .database import Base, engine
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+# On Postgres the messages table is range-partitioned by timestamp. The
+# partition key has to be part of the primary key, and a foreign key can only
+# reference a unique constraint, so reactions and read statuses keep a plain
+# message_id column there instead of a foreign key to messages.id.
+PARTITION_MESSAGES = engine.dialect.name == "postgresql"
+
+def message_fk():
+    return () if PARTITION_MESSAGES else (ForeignKey('messages.id'),)
+
 class User(Base):
     __tablename__ = 'users'
 
@@ -40,6 +50,7 @@ class ChatRoom(Base):
 
     messages = relationship("Message", back_populates="chat_room")
     memberships = relationship("Membership", back_populates="chat_room")
+    retention_policy = relationship("RetentionPolicy", back_populates="chat_room", uselist=False)
 
 class Membership(Base):
     __tablename__ = 'memberships'
@@ -53,35 +64,55 @@ class Membership(Base):
 
 class Message(Base):
     __tablename__ = 'messages'
+    __table_args__ = (
+        Index('ix_messages_chat_room_id_timestamp', 'chat_room_id', 'timestamp'),
+        {'postgresql_partition_by': 'RANGE (timestamp)'},
+    )
 
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True, autoincrement=True, index=True)
     content = Column(String, nullable=False)
-    timestamp = Column(DateTime(timezone=True), server_default=func.now())
+    timestamp = Column(DateTime(timezone=True), server_default=func.now(), primary_key=PARTITION_MESSAGES)
     user_id = Column(Integer, ForeignKey('users.id'))
     chat_room_id = Column(Integer, ForeignKey('chat_rooms.id'))
     is_attachment = Column(Boolean, default=False)
 
     user = relationship("User", back_populates="messages")
     chat_room = relationship("ChatRoom", back_populates="messages")
-    reactions = relationship("Reaction", back_populates="message")
-    read_statuses = relationship("MessageReadStatus", back_populates="message")
+    reactions = relationship(
+        "Reaction", back_populates="message", primaryjoin="Message.id == foreign(Reaction.message_id)"
+    )
+    read_statuses = relationship(
+        "MessageReadStatus", back_populates="message", primaryjoin="Message.id == foreign(MessageReadStatus.message_id)"
+    )
 
 class Reaction(Base):
     __tablename__ = 'reactions'
 
     user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
-    message_id = Column(Integer, ForeignKey('messages.id'), primary_key=True)
+    message_id = Column(Integer, *message_fk(), primary_key=True)
     reaction_type = Column(String, nullable=False)
 
     user = relationship("User", back_populates="reactions")
-    message = relationship("Message", back_populates="reactions")
+    message = relationship(
+        "Message", back_populates="reactions", primaryjoin="Message.id == foreign(Reaction.message_id)"
+    )
 
 class MessageReadStatus(Base):
     __tablename__ = 'message_read_status'
 
     user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
-    message_id = Column(Integer, ForeignKey('messages.id'), primary_key=True)
+    message_id = Column(Integer, *message_fk(), primary_key=True)
     read_at = Column(DateTime, default=func.now())
 
     user = relationship("User", back_populates="read_statuses")
-    message = relationship("Message", back_populates="read_statuses")
\ No newline at end of file
+    message = relationship(
+        "Message", back_populates="read_statuses", primaryjoin="Message.id == foreign(MessageReadStatus.message_id)"
+    )
+
+class RetentionPolicy(Base):
+    __tablename__ = 'retention_policies'
+
+    chat_room_id = Column(Integer, ForeignKey('chat_rooms.id'), primary_key=True)
+    retention_days = Column(Integer, nullable=True)  # None uses the global retention period
+
+    chat_room = relationship("ChatRoom", back_populates="retention_policy")
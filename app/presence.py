@@ -0,0 +1,272 @@
+import os
+import time
+import asyncio
+import logging
+import uuid
+from collections import defaultdict, Counter
+from typing import Awaitable, Callable, DefaultDict
+
+logger = logging.getLogger(__name__)
+
+PRESENCE_HEARTBEAT_INTERVAL = float(os.getenv("PRESENCE_HEARTBEAT_INTERVAL", 10))
+PRESENCE_TTL = float(os.getenv("PRESENCE_TTL", 30))
+
+PublishFn = Callable[[str, dict], Awaitable[None]]
+
+
+def presence_key(chat_room_id: int) -> str:
+    return f"presence:chat_room_{chat_room_id}"
+
+
+def presence_users_key(chat_room_id: int) -> str:
+    return f"presence:chat_room_{chat_room_id}:users"
+
+
+# The scripts below keep the sorted set and the hash in step: a user's count
+# in the hash always equals the number of their members in the sorted set.
+
+# KEYS: sorted set, hash. ARGV: member, username, score, ttl.
+# Returns the number of workers now holding the user, or 0 if this worker
+# already held them.
+ADD_SCRIPT = """
+local added = redis.call('ZADD', KEYS[1], ARGV[3], ARGV[1])
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+if added == 0 then
+    return 0
+end
+local workers = redis.call('HINCRBY', KEYS[2], ARGV[2], 1)
+redis.call('EXPIRE', KEYS[2], ARGV[4])
+return workers
+"""
+
+# KEYS: sorted set, hash. ARGV: member, username.
+# Returns the number of workers still holding the user, or -1 if the member
+# was already gone.
+REMOVE_SCRIPT = """
+if redis.call('ZREM', KEYS[1], ARGV[1]) == 0 then
+    return -1
+end
+local workers = redis.call('HINCRBY', KEYS[2], ARGV[2], -1)
+if workers <= 0 then
+    redis.call('HDEL', KEYS[2], ARGV[2])
+end
+return workers
+"""
+
+# KEYS: sorted set, hash. ARGV: now, cutoff, ttl, worker id, usernames...
+# Refreshes this worker's members, re-adding any that another worker pruned
+# while this one was stalled, then prunes members older than the cutoff.
+# Returns the usernames that came back online and those that went offline.
+HEARTBEAT_SCRIPT = """
+local joined, left = {}, {}
+for i = 5, #ARGV do
+    local username = ARGV[i]
+    if redis.call('ZADD', KEYS[1], ARGV[1], ARGV[4] .. ':' .. username) == 1 then
+        if redis.call('HINCRBY', KEYS[2], username, 1) == 1 then
+            table.insert(joined, username)
+        end
+    end
+end
+for _, member in ipairs(redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', '(' .. ARGV[2])) do
+    local username = string.sub(member, string.find(member, ':', 1, true) + 1)
+    redis.call('ZREM', KEYS[1], member)
+    if redis.call('HINCRBY', KEYS[2], username, -1) <= 0 then
+        redis.call('HDEL', KEYS[2], username)
+        table.insert(left, username)
+    end
+end
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+return {joined, left}
+"""
+
+
+class PresenceService:
+    """
+    Tracks which users are online in each chat room across all workers.
+
+    Every room has two Redis keys. A sorted set holds one "worker_id:username"
+    member per worker holding a connection, scored by that worker's last
+    heartbeat. A hash maps each username to the number of workers holding it,
+    so the room's online count is HLEN and a user only goes offline once the
+    last worker lets go of them. Both keys are only changed through Lua
+    scripts, so they cannot drift apart if a worker dies mid-update.
+
+    Workers only write to Redis when a user's first local connection opens,
+    when their last local connection closes, and on the periodic heartbeat,
+    which refreshes every locally connected user in a single pipeline.
+    Members left behind by a crashed worker stop being refreshed and are
+    pruned once they are older than PRESENCE_TTL.
+    """
+
+    def __init__(self, redis_client, publish: PublishFn,
+                 heartbeat_interval: float = PRESENCE_HEARTBEAT_INTERVAL,
+                 ttl: float = PRESENCE_TTL):
+        self.redis_client = redis_client
+        self.publish = publish
+        self.heartbeat_interval = heartbeat_interval
+        self.ttl = ttl
+        self.worker_id = uuid.uuid4().hex
+        # chat_room_id -> username -> number of open connections on this worker
+        self.local_rooms: DefaultDict[int, Counter] = defaultdict(Counter)
+        self._heartbeat_task = None
+        if redis_client is not None:
+            self._add_script = redis_client.register_script(ADD_SCRIPT)
+            self._remove_script = redis_client.register_script(REMOVE_SCRIPT)
+            self._heartbeat_script = redis_client.register_script(HEARTBEAT_SCRIPT)
+
+    async def start(self):
+        """
+        Start the background heartbeat task.
+        """
+        logger.debug(f"Starting presence heartbeats for worker {self.worker_id}")
+        self._heartbeat_task = asyncio.create_task(self._heartbeat_loop())
+
+    async def stop(self):
+        """
+        Stop heartbeating and release this worker's hold on every user.
+        """
+        if self._heartbeat_task:
+            self._heartbeat_task.cancel()
+            try:
+                await self._heartbeat_task
+            except asyncio.CancelledError:
+                pass
+            self._heartbeat_task = None
+        rooms = list(self.local_rooms.items())
+        self.local_rooms.clear()
+        for chat_room_id, users in rooms:
+            for username in users:
+                if await self._remove(chat_room_id, username):
+                    await self._publish_delta(chat_room_id, "leave", username)
+
+    async def join(self, chat_room_id: int, username: str):
+        """
+        Register a new connection and announce the user if they just came online.
+        """
+        users = self.local_rooms[chat_room_id]
+        users[username] += 1
+        if users[username] > 1:
+            return
+        try:
+            added = await self._add(chat_room_id, username)
+        except Exception:
+            self._release(chat_room_id, username)
+            raise
+        if added:
+            await self._publish_delta(chat_room_id, "join", username)
+
+    async def leave(self, chat_room_id: int, username: str):
+        """
+        Unregister a connection and announce the user if it was their last one
+        anywhere in the cluster.
+        """
+        users = self.local_rooms.get(chat_room_id)
+        if not users or username not in users:
+            return
+        users[username] -= 1
+        if users[username] > 0:
+            return
+        self._release(chat_room_id, username)
+        if await self._remove(chat_room_id, username):
+            await self._publish_delta(chat_room_id, "leave", username)
+
+    def _release(self, chat_room_id: int, username: str):
+        users = self.local_rooms.get(chat_room_id)
+        if users is None:
+            return
+        users.pop(username, None)
+        if not users:
+            del self.local_rooms[chat_room_id]
+
+    async def online_count(self, chat_room_id: int) -> int:
+        """
+        Number of distinct users online in a chat room across the cluster.
+        """
+        return await self.redis_client.hlen(presence_users_key(chat_room_id))
+
+    def _member(self, username: str) -> str:
+        return f"{self.worker_id}:{username}"
+
+    async def _add(self, chat_room_id: int, username: str) -> bool:
+        """
+        Record that this worker holds the user, returning True if no other
+        worker did.
+        """
+        workers = await self._add_script(
+            keys=[presence_key(chat_room_id), presence_users_key(chat_room_id)],
+            args=[self._member(username), username, time.time(), int(self.ttl)],
+        )
+        return workers == 1
+
+    async def _remove(self, chat_room_id: int, username: str) -> bool:
+        """
+        Drop this worker's hold on the user, returning True if it was the last one.
+        """
+        workers = await self._remove_script(
+            keys=[presence_key(chat_room_id), presence_users_key(chat_room_id)],
+            args=[self._member(username), username],
+        )
+        return workers == 0
+
+    async def _publish_delta(self, chat_room_id: int, event: str, username: str):
+        msg = {"type": "presence", "event": event, "username": username}
+        try:
+            await self.publish(f"chat_room_{chat_room_id}", msg)
+            logger.debug(f"Published presence {event} for {username} in chat room {chat_room_id}")
+        except Exception as e:
+            logger.error(f"Error publishing presence delta: {e}", exc_info=True)
+
+    async def heartbeat(self):
+        """
+        Refresh every locally connected user and prune expired members, one
+        script call per room.
+
+        Expired members belong to a worker that stopped heartbeating; a leave
+        delta is published for each user that no other worker still holds. If
+        this worker was the one that stalled, its pruned members are added back
+        and a join delta is published for users that had gone offline.
+        """
+        if not self.local_rooms:
+            return
+        now = time.time()
+        cutoff = now - self.ttl
+        for chat_room_id, users in list(self.local_rooms.items()):
+            joined, left = await self._heartbeat_script(
+                keys=[presence_key(chat_room_id), presence_users_key(chat_room_id)],
+                args=[now, cutoff, int(self.ttl), self.worker_id, *users],
+            )
+            for username in joined:
+                await self._publish_delta(chat_room_id, "join", username)
+            for username in left:
+                await self._publish_delta(chat_room_id, "leave", username)
+
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                await self.heartbeat()
+            except Exception as e:
+                logger.error(f"Error sending presence heartbeat: {e}", exc_info=True)
+
+
+class LocalPresenceService(PresenceService):
+    """
+    Presence for single-node deployments without Redis, where this worker's
+    own connections are the whole picture.
+    """
+
+    def __init__(self, publish: PublishFn):
+        super().__init__(None, publish)
+
+    async def online_count(self, chat_room_id: int) -> int:
+        return len(self.local_rooms.get(chat_room_id, ()))
+
+    async def _add(self, chat_room_id: int, username: str) -> bool:
+        return True
+
+    async def _remove(self, chat_room_id: int, username: str) -> bool:
+        return True
+
+    async def heartbeat(self):
+        pass
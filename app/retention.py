@@ -0,0 +1,432 @@
+import os
+import re
+import gzip
+import json
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterator, List, Optional
+from sqlalchemy import text
+from sqlalchemy.orm import Session, selectinload
+from . import models
+from .database import SessionLocal, engine
+
+logger = logging.getLogger(__name__)
+
+# Days to keep messages in every room; 0 keeps them forever. On Postgres,
+# whole monthly partitions past this period are archived and dropped.
+MESSAGE_RETENTION_DAYS = int(os.getenv("MESSAGE_RETENTION_DAYS", 0))
+# Shortest retention period a chat room's own policy may set
+MIN_RETENTION_DAYS = int(os.getenv("MIN_RETENTION_DAYS", 30))
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+ARCHIVE_INTERVAL_SECONDS = float(os.getenv("ARCHIVE_INTERVAL_SECONDS", 3600))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", 1000))
+PARTITION_MONTHS_AHEAD = int(os.getenv("PARTITION_MONTHS_AHEAD", 2))
+# Most archived messages a single search request reads back
+ARCHIVE_SEARCH_LIMIT = int(os.getenv("ARCHIVE_SEARCH_LIMIT", 100))
+# Set to "false" on processes that should not run the archiver. On Postgres
+# an advisory lock already keeps concurrent archivers from overlapping.
+ARCHIVER_ENABLED = os.getenv("ARCHIVER_ENABLED", "true").lower() == "true"
+ARCHIVER_LOCK_ID = 726_173_001
+
+PARTITION_NAME = re.compile(r"^messages_p(\d{4})(\d{2})$")
+
+
+def utcnow() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def month_start(value: datetime) -> datetime:
+    return value.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def next_month(value: datetime) -> datetime:
+    return month_start(month_start(value) + timedelta(days=32))
+
+
+def global_cutoff(now: Optional[datetime] = None) -> Optional[datetime]:
+    if not MESSAGE_RETENTION_DAYS:
+        return None
+    return (now or utcnow()) - timedelta(days=MESSAGE_RETENTION_DAYS)
+
+
+# Partition management (Postgres only)
+
+def messages_is_partitioned(db: Session) -> bool:
+    result = db.execute(
+        text(
+            "SELECT 1 FROM pg_partitioned_table p "
+            "JOIN pg_class c ON c.oid = p.partrelid WHERE c.relname = 'messages'"
+        )
+    )
+    return result.first() is not None
+
+
+def list_partitions(db: Session) -> List[str]:
+    result = db.execute(
+        text(
+            "SELECT child.relname FROM pg_inherits i "
+            "JOIN pg_class parent ON parent.oid = i.inhparent "
+            "JOIN pg_class child ON child.oid = i.inhrelid "
+            "WHERE parent.relname = 'messages'"
+        )
+    )
+    return [row[0] for row in result]
+
+
+def partition_bounds(name: str) -> Optional[tuple]:
+    match = PARTITION_NAME.match(name)
+    if not match:
+        return None
+    start = datetime(int(match.group(1)), int(match.group(2)), 1, tzinfo=timezone.utc)
+    return start, next_month(start)
+
+
+def create_partition(db: Session, start: datetime):
+    """
+    Create the monthly partition starting at `start`.
+
+    Postgres refuses to create a partition while the default partition holds
+    rows in its range, so such rows are first moved into a standalone table,
+    which is then attached as the new partition.
+    """
+    end = next_month(start)
+    name = f"messages_p{start:%Y%m}"
+    bounds = f"FROM ('{start:%Y-%m-%d} 00:00:00+00') TO ('{end:%Y-%m-%d} 00:00:00+00')"
+    in_range = f"timestamp >= '{start:%Y-%m-%d} 00:00:00+00' AND timestamp < '{end:%Y-%m-%d} 00:00:00+00'"
+    has_default = db.execute(text("SELECT to_regclass('messages_default')")).scalar() is not None
+    if has_default and db.execute(text(f"SELECT 1 FROM messages_default WHERE {in_range} LIMIT 1")).first():
+        logger.warning(f"Moving rows for {name} out of the default message partition")
+        db.execute(text(f"CREATE TABLE {name} (LIKE messages INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"))
+        db.execute(text(f"INSERT INTO {name} SELECT * FROM messages_default WHERE {in_range}"))
+        db.execute(text(f"DELETE FROM messages_default WHERE {in_range}"))
+        db.execute(text(f"ALTER TABLE messages ATTACH PARTITION {name} FOR VALUES {bounds}"))
+    else:
+        db.execute(text(f"CREATE TABLE {name} PARTITION OF messages FOR VALUES {bounds}"))
+
+
+def ensure_partitions(db: Session, now: Optional[datetime] = None):
+    """
+    Create monthly partitions of the messages table from the current month up
+    to PARTITION_MONTHS_AHEAD months ahead, plus a default partition so that
+    inserts never fail if the archiver falls behind.
+    """
+    if not models.PARTITION_MESSAGES:
+        return
+    if not messages_is_partitioned(db):
+        logger.warning("The messages table is not partitioned; it was created before partitioning was enabled")
+        return
+    existing = set(list_partitions(db))
+    start = month_start(now or utcnow())
+    for _ in range(PARTITION_MONTHS_AHEAD + 1):
+        name = f"messages_p{start:%Y%m}"
+        if name not in existing:
+            try:
+                create_partition(db, start)
+                db.commit()
+                logger.info(f"Created message partition {name}")
+            except Exception as e:
+                db.rollback()
+                logger.error(f"Error creating message partition {name}: {e}", exc_info=True)
+        start = next_month(start)
+    if "messages_default" not in existing:
+        db.execute(text("CREATE TABLE IF NOT EXISTS messages_default PARTITION OF messages DEFAULT"))
+        db.commit()
+    logger.debug("Message partitions are up to date")
+
+
+def expired_partitions(db: Session, now: Optional[datetime] = None) -> List[str]:
+    """
+    Names of monthly partitions that lie entirely before the global cutoff.
+    """
+    cutoff = global_cutoff(now)
+    if cutoff is None or not models.PARTITION_MESSAGES or not messages_is_partitioned(db):
+        return []
+    expired = []
+    for name in sorted(list_partitions(db)):
+        bounds = partition_bounds(name)
+        if bounds and bounds[1] <= cutoff:
+            expired.append(name)
+    return expired
+
+
+# Retention policy
+
+def retention_cutoffs(db: Session, now: Optional[datetime] = None) -> Dict[int, datetime]:
+    """
+    Map each chat room whose own policy is stricter than the global retention
+    period to the timestamp before which its messages expire. Other rooms are
+    covered by the global cutoff.
+    """
+    now = now or utcnow()
+    cutoff = global_cutoff(now)
+    cutoffs = {}
+    for policy in db.query(models.RetentionPolicy).all():
+        if not policy.retention_days:
+            continue
+        room_cutoff = now - timedelta(days=policy.retention_days)
+        if cutoff is None or room_cutoff > cutoff:
+            cutoffs[policy.chat_room_id] = room_cutoff
+    return cutoffs
+
+
+# Archive files
+
+def archive_room_dir(chat_room_id: int) -> str:
+    return os.path.join(ARCHIVE_DIR, f"chat_room_{chat_room_id}")
+
+
+def archive_path(chat_room_id: int, month: str) -> str:
+    return os.path.join(archive_room_dir(chat_room_id), f"{month}.jsonl.gz")
+
+
+def read_archive_index(chat_room_id: int) -> Dict[str, dict]:
+    """
+    Map each month file of a chat room to the range of message ids it holds.
+    """
+    path = os.path.join(archive_room_dir(chat_room_id), "index.json")
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as index_file:
+        return json.load(index_file)
+
+
+def update_archive_index(chat_room_id: int, month: str, message_ids: List[int]):
+    index = read_archive_index(chat_room_id)
+    entry = index.get(month)
+    if entry:
+        message_ids = message_ids + [entry["min_id"], entry["max_id"]]
+    index[month] = {"min_id": min(message_ids), "max_id": max(message_ids)}
+    path = os.path.join(archive_room_dir(chat_room_id), "index.json")
+    with open(f"{path}.tmp", "w", encoding="utf-8") as index_file:
+        json.dump(index, index_file)
+    os.replace(f"{path}.tmp", path)
+
+
+def serialize_message(message: models.Message) -> dict:
+    return {
+        "id": message.id,
+        "content": message.content,
+        "timestamp": message.timestamp.isoformat(),
+        "user_id": message.user_id,
+        "chat_room_id": message.chat_room_id,
+        "is_attachment": message.is_attachment,
+        "reactions": [
+            {"user_id": reaction.user_id, "reaction_type": reaction.reaction_type}
+            for reaction in message.reactions
+        ],
+    }
+
+
+def write_archive(chat_room_id: int, messages: List[models.Message]):
+    """
+    Append messages to the room's monthly archive files.
+
+    Every call appends a new gzip member, so existing data is never rewritten
+    and gzip readers see each file as one continuous stream.
+    """
+    by_month: Dict[str, List[models.Message]] = {}
+    for message in messages:
+        by_month.setdefault(f"{message.timestamp:%Y-%m}", []).append(message)
+    for month, month_messages in by_month.items():
+        path = archive_path(chat_room_id, month)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        lines = [json.dumps(serialize_message(message)) for message in month_messages]
+        with open(path, "ab") as archive:
+            archive.write(gzip.compress(("\n".join(lines) + "\n").encode("utf-8")))
+            archive.flush()
+            os.fsync(archive.fileno())
+        update_archive_index(chat_room_id, month, [message.id for message in month_messages])
+
+
+def iter_archived_messages(chat_room_id: int, before_id: Optional[int] = None) -> Iterator[dict]:
+    """
+    Yield archived messages of a chat room older than `before_id`, newest
+    month first and newest message first within a month.
+
+    Month files are only decompressed when the caller gets to them, and files
+    whose indexed ids all fall at or after `before_id` are skipped unread.
+    """
+    room_dir = archive_room_dir(chat_room_id)
+    if not os.path.isdir(room_dir):
+        return
+    index = read_archive_index(chat_room_id)
+    for filename in sorted(os.listdir(room_dir), reverse=True):
+        if not filename.endswith(".jsonl.gz"):
+            continue
+        entry = index.get(filename[:-len(".jsonl.gz")])
+        if before_id is not None and entry and entry["min_id"] >= before_id:
+            continue
+        records = {}
+        with gzip.open(os.path.join(room_dir, filename), "rt", encoding="utf-8") as archive:
+            for line in archive:
+                if line.strip():
+                    record = json.loads(line)
+                    if before_id is not None and record["id"] >= before_id:
+                        continue
+                    # A batch archived again after a crash shows up twice
+                    records[record["id"]] = record
+        yield from sorted(records.values(), key=lambda record: (record["timestamp"], record["id"]), reverse=True)
+
+
+def search_archived_messages(chat_room_id: int, query: str, limit: int = ARCHIVE_SEARCH_LIMIT) -> List[dict]:
+    matches = []
+    for record in iter_archived_messages(chat_room_id):
+        if query in record["content"]:
+            matches.append(record)
+            if len(matches) >= limit:
+                break
+    return matches
+
+
+def archived_history(chat_room_id: int, before_id: Optional[int], limit: int) -> List[dict]:
+    history = []
+    for record in iter_archived_messages(chat_room_id, before_id):
+        history.append(record)
+        if len(history) >= limit:
+            break
+    return history
+
+
+# Archiver
+
+def delete_message_rows(db: Session, message_ids: List[int]):
+    db.query(models.Reaction).filter(
+        models.Reaction.message_id.in_(message_ids)
+    ).delete(synchronize_session=False)
+    db.query(models.MessageReadStatus).filter(
+        models.MessageReadStatus.message_id.in_(message_ids)
+    ).delete(synchronize_session=False)
+
+
+def archive_expired_messages(db: Session, chat_room_id: int, cutoff: datetime) -> int:
+    """
+    Move messages older than the cutoff from the database to the archive in
+    batches. Each batch is written to disk before it is deleted, so a crash
+    can at worst archive a batch twice, never lose it.
+    """
+    archived = 0
+    while True:
+        messages = (
+            db.query(models.Message)
+            .options(selectinload(models.Message.reactions))
+            .filter(
+                models.Message.chat_room_id == chat_room_id,
+                models.Message.timestamp < cutoff,
+            )
+            .order_by(models.Message.timestamp, models.Message.id)
+            .limit(ARCHIVE_BATCH_SIZE)
+            .all()
+        )
+        if not messages:
+            break
+        write_archive(chat_room_id, messages)
+        message_ids = [message.id for message in messages]
+        delete_message_rows(db, message_ids)
+        db.query(models.Message).filter(
+            models.Message.chat_room_id == chat_room_id,
+            models.Message.id.in_(message_ids),
+        ).delete(synchronize_session=False)
+        db.commit()
+        db.expunge_all()
+        archived += len(messages)
+    return archived
+
+
+def archive_partition(db: Session, name: str) -> int:
+    """
+    Archive every message in a monthly partition, then detach and drop it.
+
+    The messages themselves are never deleted row by row; dropping the
+    partition releases its heap and indexes at once, with nothing left for
+    vacuum. A crash before the drop only means the partition is archived
+    again on the next pass.
+    """
+    start, end = partition_bounds(name)
+    archived = 0
+    last_id = 0
+    while True:
+        messages = (
+            db.query(models.Message)
+            .options(selectinload(models.Message.reactions))
+            .filter(
+                models.Message.timestamp >= start,
+                models.Message.timestamp < end,
+                models.Message.id > last_id,
+            )
+            .order_by(models.Message.id)
+            .limit(ARCHIVE_BATCH_SIZE)
+            .all()
+        )
+        if not messages:
+            break
+        by_room: Dict[int, List[models.Message]] = {}
+        for message in messages:
+            by_room.setdefault(message.chat_room_id, []).append(message)
+        for chat_room_id, room_messages in by_room.items():
+            write_archive(chat_room_id, room_messages)
+        delete_message_rows(db, [message.id for message in messages])
+        db.commit()
+        last_id = messages[-1].id
+        db.expunge_all()
+        archived += len(messages)
+    db.execute(text(f"ALTER TABLE messages DETACH PARTITION {name}"))
+    db.execute(text(f"DROP TABLE {name}"))
+    db.commit()
+    logger.info(f"Archived {archived} messages and dropped message partition {name}")
+    return archived
+
+
+def run_retention_pass():
+    """
+    Run one archiver pass, unless another process holds the archiver lock.
+    """
+    if not models.PARTITION_MESSAGES:
+        retention_pass()
+        return
+    with engine.connect() as lock_connection:
+        locked = lock_connection.execute(
+            text("SELECT pg_try_advisory_lock(:lock_id)"), {"lock_id": ARCHIVER_LOCK_ID}
+        ).scalar()
+        if not locked:
+            logger.debug("Another process is archiving messages, skipping this pass")
+            return
+        try:
+            retention_pass()
+        finally:
+            lock_connection.execute(text("SELECT pg_advisory_unlock(:lock_id)"), {"lock_id": ARCHIVER_LOCK_ID})
+
+
+def retention_pass():
+    db = SessionLocal()
+    try:
+        ensure_partitions(db)
+        for chat_room_id, cutoff in retention_cutoffs(db).items():
+            archived = archive_expired_messages(db, chat_room_id, cutoff)
+            if archived:
+                logger.info(f"Archived {archived} messages from chat room {chat_room_id}")
+        cutoff = global_cutoff()
+        if cutoff is None:
+            return
+        if models.PARTITION_MESSAGES and messages_is_partitioned(db):
+            for name in expired_partitions(db):
+                archive_partition(db, name)
+            # Anything older than the oldest remaining monthly partition sits in
+            # the default partition and is archived row by row
+            starts = [bounds[0] for bounds in map(partition_bounds, list_partitions(db)) if bounds]
+            cutoff = min([cutoff] + starts)
+        for (chat_room_id,) in db.query(models.ChatRoom.id).all():
+            archived = archive_expired_messages(db, chat_room_id, cutoff)
+            if archived:
+                logger.info(f"Archived {archived} messages from chat room {chat_room_id}")
+    finally:
+        db.close()
+
+
+async def run_archiver():
+    while True:
+        try:
+            await asyncio.to_thread(run_retention_pass)
+        except Exception as e:
+            logger.error(f"Error during message archival: {e}", exc_info=True)
+        await asyncio.sleep(ARCHIVE_INTERVAL_SECONDS)
@@ -1,5 +1,6 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from datetime import datetime
+from typing import Optional
 
 class UserBase(BaseModel):
     username: str
@@ -71,4 +72,17 @@ class MessageReadStatus(MessageReadStatusBase):
     message_id: int
 
     class Config:
-        from_attributes = True
\ No newline at end of file
+        from_attributes = True
+
+class RetentionPolicyUpdate(BaseModel):
+    retention_days: Optional[int] = Field(None, ge=1)  # None uses the global retention period
+
+class RetentionPolicy(RetentionPolicyUpdate):
+    chat_room_id: int
+
+    class Config:
+        from_attributes = True
+
+class Presence(BaseModel):
+    chat_room_id: int
+    online_count: int
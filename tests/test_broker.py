@@ -0,0 +1,53 @@
+import asyncio
+import pytest
+from app.broker import Broker, InMemoryBroker, SubscriptionClosed
+
+
+def test_publish_reaches_channel_subscribers_only():
+    async def scenario():
+        broker = InMemoryBroker()
+        first = await broker.subscribe("chat_room_1")
+        second = await broker.subscribe("chat_room_1")
+        other = await broker.subscribe("chat_room_2")
+        msg = {"type": "chat", "content": "hi"}
+        await broker.publish("chat_room_1", msg)
+        # Subscribers receive the published dict itself, not a copy
+        assert await first.get_message(timeout=0.1) is msg
+        assert await second.get_message(timeout=0.1) is msg
+        assert await other.get_message(timeout=0.01) is None
+
+    asyncio.run(scenario())
+
+
+def test_unsubscribe_stops_delivery():
+    async def scenario():
+        broker = InMemoryBroker()
+        subscription = await broker.subscribe("chat_room_1")
+        await subscription.unsubscribe()
+        assert "chat_room_1" not in broker.channels
+        await broker.publish("chat_room_1", {"type": "typing"})
+        assert await subscription.get_message(timeout=0.01) is None
+
+    asyncio.run(scenario())
+
+
+def test_slow_subscriber_is_closed():
+    async def scenario():
+        broker = InMemoryBroker(max_queue_size=2)
+        slow = await broker.subscribe("chat_room_1")
+        for index in range(3):
+            await broker.publish("chat_room_1", {"index": index})
+        assert "chat_room_1" not in broker.channels
+        with pytest.raises(SubscriptionClosed):
+            await slow.get_message(timeout=0.01)
+
+    asyncio.run(scenario())
+
+
+def test_incomplete_broker_cannot_be_created():
+    class PublishOnlyBroker(Broker):
+        async def publish(self, channel, message):
+            pass
+
+    with pytest.raises(TypeError):
+        PublishOnlyBroker()
@@ -0,0 +1,115 @@
+import asyncio
+import fakeredis
+from app.presence import PresenceService, presence_key
+
+
+async def stall(redis, worker):
+    """
+    Age a worker's members past the TTL, as if it had stopped heartbeating.
+    """
+    for member in await redis.zrange(presence_key(1), 0, -1):
+        if member.startswith(worker.worker_id):
+            await redis.zadd(presence_key(1), {member: 0})
+
+
+def make_workers(redis, count=2):
+    deltas = []
+
+    async def publish(channel, msg):
+        deltas.append((channel, msg["event"], msg["username"]))
+
+    return [PresenceService(redis, publish) for _ in range(count)], deltas
+
+
+def test_user_stays_online_until_last_worker_leaves():
+    async def scenario():
+        redis = fakeredis.FakeAsyncRedis(decode_responses=True)
+        (worker_a, worker_b), deltas = make_workers(redis)
+        await worker_a.join(1, "alice")
+        await worker_b.join(1, "alice")
+        await worker_a.join(1, "alice")
+        assert deltas == [("chat_room_1", "join", "alice")]
+        assert await worker_a.online_count(1) == 1
+
+        await worker_a.leave(1, "alice")
+        await worker_a.leave(1, "alice")
+        assert deltas == [("chat_room_1", "join", "alice")]
+        assert await worker_b.online_count(1) == 1
+
+        await worker_b.leave(1, "alice")
+        assert deltas[-1] == ("chat_room_1", "leave", "alice")
+        assert await worker_b.online_count(1) == 0
+
+    asyncio.run(scenario())
+
+
+def test_stop_keeps_users_held_by_other_workers():
+    async def scenario():
+        redis = fakeredis.FakeAsyncRedis(decode_responses=True)
+        (worker_a, worker_b), deltas = make_workers(redis)
+        await worker_a.join(1, "alice")
+        await worker_a.join(1, "bob")
+        await worker_b.join(1, "alice")
+        await worker_a.stop()
+        assert deltas[-1] == ("chat_room_1", "leave", "bob")
+        assert ("chat_room_1", "leave", "alice") not in deltas
+        assert await worker_b.online_count(1) == 1
+
+    asyncio.run(scenario())
+
+
+def test_heartbeat_prunes_crashed_worker():
+    async def scenario():
+        redis = fakeredis.FakeAsyncRedis(decode_responses=True)
+        (worker_a, worker_b), deltas = make_workers(redis)
+        await worker_a.join(1, "alice")
+        await worker_a.join(1, "bob")
+        await worker_b.join(1, "bob")
+        await stall(redis, worker_a)
+        await worker_b.heartbeat()
+        assert deltas[-1] == ("chat_room_1", "leave", "alice")
+        assert ("chat_room_1", "leave", "bob") not in deltas
+        assert await worker_b.online_count(1) == 1
+
+    asyncio.run(scenario())
+
+
+def test_failed_join_is_not_tracked_locally():
+    async def scenario():
+        server = fakeredis.FakeServer()
+        server.connected = False
+        (worker,), _ = make_workers(fakeredis.FakeAsyncRedis(server=server, decode_responses=True), count=1)
+        try:
+            await worker.join(1, "alice")
+        except Exception:
+            pass
+        assert not worker.local_rooms
+
+    asyncio.run(scenario())
+
+
+def test_stalled_worker_recovers_its_members():
+    async def scenario():
+        redis = fakeredis.FakeAsyncRedis(decode_responses=True)
+        (worker_a, worker_b), deltas = make_workers(redis)
+        await worker_a.join(1, "alice")
+        await worker_b.join(1, "alice")
+        await worker_a.join(1, "bob")
+        # Worker A stalls, B prunes its members, then A heartbeats again
+        await stall(redis, worker_a)
+        await worker_b.heartbeat()
+        assert deltas[-1] == ("chat_room_1", "leave", "bob")
+        await worker_a.heartbeat()
+        assert deltas[-1] == ("chat_room_1", "join", "bob")
+        assert await worker_a.online_count(1) == 2
+
+        await worker_b.leave(1, "alice")
+        assert ("chat_room_1", "leave", "alice") not in deltas
+        assert await worker_a.online_count(1) == 2
+
+        await worker_a.leave(1, "alice")
+        await worker_a.leave(1, "bob")
+        assert deltas[-2:] == [("chat_room_1", "leave", "alice"), ("chat_room_1", "leave", "bob")]
+        assert await redis.hgetall("presence:chat_room_1:users") == {}
+
+    asyncio.run(scenario())
@@ -0,0 +1,95 @@
+from datetime import datetime, timedelta, timezone
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+from app import models, retention
+
+
+@pytest.fixture(autouse=True)
+def archive_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(retention, "ARCHIVE_DIR", str(tmp_path))
+    return tmp_path
+
+
+@pytest.fixture
+def db():
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    models.Base.metadata.create_all(bind=engine)
+    session = sessionmaker(bind=engine)()
+    yield session
+    session.close()
+
+
+def make_message(message_id, content, timestamp, chat_room_id=1):
+    return models.Message(
+        id=message_id,
+        content=content,
+        timestamp=timestamp,
+        user_id=1,
+        chat_room_id=chat_room_id,
+        is_attachment=False,
+    )
+
+
+def test_archive_round_trip():
+    retention.write_archive(1, [
+        make_message(1, "hello", datetime(2026, 8, 30)),
+        make_message(2, "hello again", datetime(2026, 9, 1)),
+    ])
+    retention.write_archive(1, [
+        make_message(3, "goodbye", datetime(2026, 9, 2)),
+        # Archived twice after a crash
+        make_message(2, "hello again", datetime(2026, 9, 1)),
+    ])
+
+    history = retention.archived_history(1, before_id=None, limit=10)
+    assert [record["id"] for record in history] == [3, 2, 1]
+    assert [record["id"] for record in retention.archived_history(1, before_id=3, limit=1)] == [2]
+    assert [record["id"] for record in retention.search_archived_messages(1, "hello")] == [2, 1]
+    assert retention.archived_history(2, before_id=None, limit=10) == []
+    assert [record["id"] for record in retention.search_archived_messages(1, "hello", limit=1)] == [2]
+
+
+def test_history_skips_month_files_by_index(archive_dir):
+    retention.write_archive(1, [make_message(1, "august", datetime(2026, 8, 30))])
+    retention.write_archive(1, [make_message(5, "september", datetime(2026, 9, 2))])
+    assert retention.read_archive_index(1) == {
+        "2026-08": {"min_id": 1, "max_id": 1},
+        "2026-09": {"min_id": 5, "max_id": 5},
+    }
+    # A corrupt September file proves it is never opened
+    (archive_dir / "chat_room_1" / "2026-09.jsonl.gz").write_bytes(b"not gzip")
+    assert [record["id"] for record in retention.archived_history(1, before_id=5, limit=10)] == [1]
+
+
+def test_archive_expired_messages_moves_rows_to_archive(db):
+    now = datetime(2026, 10, 19)
+    db.add(models.ChatRoom(id=1, name="General"))
+    db.add(make_message(1, "old", now - timedelta(days=40)))
+    db.add(make_message(2, "new", now - timedelta(days=1)))
+    db.add(models.Reaction(user_id=1, message_id=1, reaction_type="👍"))
+    db.commit()
+
+    cutoff = (now - timedelta(days=30)).replace(tzinfo=timezone.utc)
+    assert retention.archive_expired_messages(db, 1, cutoff) == 1
+
+    assert [message.id for message in db.query(models.Message).all()] == [2]
+    assert db.query(models.Reaction).count() == 0
+    archived = retention.archived_history(1, before_id=None, limit=10)
+    assert [record["content"] for record in archived] == ["old"]
+    assert archived[0]["reactions"] == [{"user_id": 1, "reaction_type": "👍"}]
+
+
+def test_room_policies_only_tighten_global_retention(db, monkeypatch):
+    monkeypatch.setattr(retention, "MESSAGE_RETENTION_DAYS", 90)
+    now = datetime(2026, 10, 19, tzinfo=timezone.utc)
+    db.add_all([
+        models.RetentionPolicy(chat_room_id=1, retention_days=30),
+        models.RetentionPolicy(chat_room_id=2, retention_days=365),
+        models.RetentionPolicy(chat_room_id=3, retention_days=None),
+    ])
+    db.commit()
+
+    assert retention.retention_cutoffs(db, now) == {1: now - timedelta(days=30)}
+    assert retention.global_cutoff(now) == now - timedelta(days=90)